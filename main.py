@@ -9,50 +9,222 @@ While caching is slightly overboard for the amount of data, it is still implemen
 via Redis to improve the performance of the program
 """
 import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import quote
 import tkinter as tk
 from tkinter import ttk, messagebox
 from PIL import Image, ImageTk
 from io import BytesIO
 import redis
-import json
+import orjson
+import re
+import unicodedata
+from collections import OrderedDict
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 # This address goes from host to docker
 redis_host = "host.docker.internal"
 redis_port = 6379
 
-cache = redis.Redis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+# Entries are cached for 1 hour, or 1 day once a country has been searched
+# a few times. Either way the expiry is refreshed each time it is loaded
+CACHE_TTL = 3600
+POPULAR_TTL = 86400
+POPULAR_HITS = 3
 
-# This function get the country data from the API using the "requests" library
+# The ETag of each response is kept for a week so expired entries can be
+# refreshed with a conditional request
+META_TTL = 7 * 86400
+
+# Size the flag is displayed (and cached) at
+FLAG_SIZE = (120, 80)
+
+# Responses are left as bytes since the flag image is cached as well, and
+# orjson reads bytes directly. The socket timeouts keep a stalled Redis from
+# blocking a lookup (and closing the window) indefinitely
+cache = redis.Redis(host=redis_host, port=redis_port, db=0, decode_responses=False,
+                    socket_timeout=2, socket_connect_timeout=2)
+
+# A single session is shared by every request so the country lookup and the
+# flag download reuse keep-alive connections instead of a new handshake each time
+_session = requests.Session()
+_session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=1))
+
+# PhotoImages already created for each flag URL, least recently used first.
+# Each one holds a Tk image, so only a limited number are kept
+_photo_cache = OrderedDict()
+PHOTO_CACHE_SIZE = 64
+
+# Lookups run on a worker thread and are polled from the Tk loop with root.after.
+# Closing the window waits for a running lookup, so every Redis and HTTP call
+# in it has a timeout
+_executor = ThreadPoolExecutor(max_workers=4)
+REQUEST_TIMEOUT = 5
+
+# Builds the Redis key for a search so that "France", "france" and " FRANCE "
+# all share one cache entry. Accents are dropped as well ("Côte" -> "cote")
+def _cache_key(country):
+    key = unicodedata.normalize("NFKD", country).casefold()
+    key = "".join(c for c in key if not unicodedata.combining(c))
+    return " ".join(key.split())
+
+# Downloads and resizes a flag. Runs on a worker thread; the PhotoImage is
+# built on the Tk thread
+def _load_flag(flag_url):
+    # flagcdn serves several widths; the smallest one above FLAG_SIZE is
+    # plenty and far cheaper to download and decode than the default w320
+    if urlparse(flag_url).hostname == "flagcdn.com":
+        flag_url = re.sub(r"/w\d+/", "/w160/", flag_url, count=1)
+
+    response = _session.get(flag_url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    # BILINEAR is plenty for a 120x80 thumbnail and cheaper than the default
+    img = Image.open(BytesIO(response.content)).convert("RGBA")
+    return img.resize(FLAG_SIZE, Image.Resampling.BILINEAR)
+
+# Runs on a worker thread so the GUI stays responsive while waiting on Redis
+# and the network. Returns the country data along with what _fetch_flag needs,
+# or None if the country could not be found
+def _fetch_country(country):
+    key = _cache_key(country)
+    # Each kind of entry has its own prefix so no search text can collide
+    # with another entry (e.g. a search for "hits:france")
+    keys = [f"country:{key}", f"flag:{key}"]
+
+    # The Redis cache is checked first to see if contacting
+    # the API can be avoided. Everything is read in one round trip
+    pipe = cache.pipeline(transaction=False)
+    pipe.mget(keys + [f"hits:{key}"])
+    pipe.hgetall(f"meta:{key}")
+    (cached, flag_pixels, hits), meta = pipe.execute()
+    hits = int(hits or 0) + 1
+    ttl = POPULAR_TTL if hits >= POPULAR_HITS else CACHE_TTL
+
+    pipe = cache.pipeline(transaction=False)
+    if cached:
+        print("Loaded from Cache")
+        data = orjson.loads(cached)
+        # Hits push the expiry back so countries in use stay cached
+        for name in keys:
+            pipe.expire(name, ttl)
+    else:
+        # Data is fetched from the API if not cached. If it was fetched before,
+        # the API is asked to only send it again if it has changed
+        # Whitespace is collapsed as in _cache_key so cached and uncached searches agree
+        url = f"https://restcountries.com/v3.1/name/{quote(' '.join(country.split()))}" # The URL for the REST Countries API
+        headers = {}
+        if b"etag" in meta:
+            headers["If-None-Match"] = meta[b"etag"].decode()
+        response = _session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+
+        if response.status_code == 304:
+            print("Cache revalidated")
+            body = meta[b"body"]
+            data = orjson.loads(body)
+        elif response.status_code == 200:
+            data = orjson.loads(response.content)[0]
+            body = orjson.dumps(data)
+            etag = response.headers.get("ETag")
+            if etag:
+                pipe.hset(f"meta:{key}", mapping={"etag": etag, "body": body})
+            else:
+                pipe.delete(f"meta:{key}")
+        else:
+            return None
+        pipe.set(keys[0], body, ex=ttl)
+        pipe.expire(f"meta:{key}", META_TTL)
+
+    # Only successful lookups are counted, so typos don't leave keys behind
+    pipe.incr(f"hits:{key}")
+    pipe.expire(f"hits:{key}", POPULAR_TTL)
+    pipe.execute()
+
+    return data, key, ttl, flag_pixels
+
+# Also runs on a worker thread, after the country text is already shown.
+# Only used when the flag is not cached; the resized pixels are then stored
+# in Redis so later hits need neither a download nor a PNG decode
+def _fetch_flag(data, key, ttl):
+    flag_url = data.get('flags', {}).get('png')
+    if not flag_url:
+        return None
+    img = _load_flag(flag_url)
+    cache.set(f"flag:{key}", img.tobytes(), ex=ttl)
+    return img
+
+# Starts a lookup for the entered country on a worker thread
 def fetch_country_data():
     country = country_entry.get().strip()
     if not country:
         messagebox.showwarning("Input Error", "Please enter a valid country")
         return
-    
 
-    # The Redis cache is checked first to see if contacting 
-    # the API can be avoided
-    cached = cache.get(country)
-    if cached:
-        print("Loaded from Cache")
-        data = json.loads(cached)
-        display_country_data(data)
+    future = _executor.submit(_fetch_country, country)
+    result_label.pending = future
+    root.after(50, poll_future, future, country)
+
+# Checks on the worker and hands its result back to the Tk thread
+def poll_future(future, country):
+    # A newer search (or Clear) has replaced this one
+    if result_label.pending is not future:
+        return
+    if not future.done():
+        root.after(50, poll_future, future, country)
         return
 
-    # Data is fetched from the API if not cached
-    url = f"https://restcountries.com/v3.1/name/{country}" # The URL for the REST Countries API
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()[0]
-            cache.set(country, json.dumps(data), ex=3600) # Data is cached for 1 hour
-            display_country_data(data)
-        else:
-            messagebox.showerror("Error", f"Country '{country}' not found.")
-            clear_display()
+        result = future.result()
     except Exception as e:
         messagebox.showerror("Error", str(e))
         clear_display()
+        return
+
+    if result is None:
+        messagebox.showerror("Error", f"Country '{country}' not found.")
+        clear_display()
+        return
+
+    data, key, ttl, flag_pixels = result
+    display_country_data(data)
+
+    # Flags already shown this session reuse their PhotoImage
+    flag_url = data.get('flags', {}).get('png')
+    tk_image = _photo_cache.get(flag_url)
+    if tk_image is not None:
+        _photo_cache.move_to_end(flag_url)
+        flag_label.pending = None
+        flag_label.config(image=tk_image)
+        flag_label.image = tk_image
+        return
+
+    # Flags cached in Redis only need rebuilding from their pixels, which is
+    # cheap enough to do here and show together with the text
+    if flag_pixels is not None:
+        flag_label.pending = None
+        display_flag(Image.frombytes("RGBA", FLAG_SIZE, flag_pixels), flag_url)
+        return
+
+    # Otherwise the flag loads separately so the text does not wait on it
+    flag_label.config(image='', text='')
+    flag_future = _executor.submit(_fetch_flag, data, key, ttl)
+    flag_label.pending = flag_future
+    root.after(50, poll_flag, flag_future, flag_url)
+
+# Same as poll_future, for the flag image
+def poll_flag(future, flag_url):
+    if flag_label.pending is not future:
+        return
+    if not future.done():
+        root.after(50, poll_flag, future, flag_url)
+        return
+
+    try:
+        flag_image = future.result()
+    except Exception:
+        flag_image = None
+    display_flag(flag_image, flag_url)
 
 # Formats all the data from the country to be displayed
 def display_country_data(data):
@@ -62,7 +234,6 @@ def display_country_data(data):
     population = f"{data.get('population', 0):,}"
     languages = ', '.join(data.get('languages', {}).values())
     currencies = ', '.join([f"{v['name']} ({v['symbol']})" for v in data.get('currencies', {}).values()])
-    flag_url = data.get('flags', {}).get('png', 'N/A')
 
     result_text.set(f"""
     Country: {name}
@@ -73,18 +244,22 @@ def display_country_data(data):
     Currencies: {currencies}
     """.strip())
 
-    # Code to Load the Countryls flag
-    try:
-        img_data = requests.get(flag_url).content
-        img = Image.open(BytesIO(img_data)).resize((120, 80))
-        tk_image = ImageTk.PhotoImage(img)
-        flag_label.config(image=tk_image)
-        flag_label.image = tk_image
-    except Exception:
+# Shows the country's flag. Only the PhotoImage is built here, on the Tk thread
+def display_flag(flag_image, flag_url):
+    if flag_image is None:
         flag_label.config(image='', text='[Flag not available]')
+        return
+    tk_image = ImageTk.PhotoImage(flag_image)
+    _photo_cache[flag_url] = tk_image
+    if len(_photo_cache) > PHOTO_CACHE_SIZE:
+        _photo_cache.popitem(last=False)
+    flag_label.config(image=tk_image)
+    flag_label.image = tk_image
 
 # clears the display of any output
 def clear_display():
+    result_label.pending = None
+    flag_label.pending = None
     result_text.set("")
     flag_label.config(image="")
 
@@ -127,4 +302,7 @@ clear_button.place(relx=0.99, rely=0.99, anchor="se")
 
 
 # GUI Loop
-root.mainloop()
\ No newline at end of file
+root.mainloop()
+
+# Lookups that have not started yet are dropped once the window is closed
+_executor.shutdown(wait=False, cancel_futures=True)
\ No newline at end of file